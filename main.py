@@ -1,49 +1,265 @@
+import json
 import math
+import multiprocessing
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import ee
 import os
 import requests
+from requests.adapters import HTTPAdapter
 import random
-from geopy.distance import geodesic
-from geopy.point import Point
 import matplotlib.pyplot as plt
 import numpy as np
-from PIL import Image, ImageChops
+from numba import njit, prange, set_num_threads
+import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+from rasterio.io import MemoryFile
+from rasterio.transform import Affine
+from rasterio.windows import Window
 
+EE_PROJECT = 'ee-francescobettisorbelli'
 
-def crop_black_borders(image_path):
-    image = Image.open(image_path).convert("RGB")
-    bg = Image.new(image.mode, image.size, (0, 0, 0))
-    diff = ImageChops.difference(image, bg)
+# High-volume endpoint, meant for many concurrent automated requests
+EE_HIGH_VOLUME_URL = 'https://earthengine-highvolume.googleapis.com'
+
+# Number of concurrent Earth Engine workers (download URL generation)
+NUM_WORKERS = 25
+
+# Number of cells described per server-side request (EE caps collections returned by getInfo at 5000 elements)
+DESCRIBE_BATCH_SIZE = 1000
+
+# Part of the EE errors raised when a download exceeds the request size or pixel grid limits,
+# the only errors for which a coarser scale is tried
+EE_SIZE_LIMIT_ERROR = 'must be less than or equal to'
+
+# Number of concurrent download threads
+NUM_DOWNLOAD_THREADS = 16
+
+# Connect and read timeouts (seconds) of a download, so that a stalled stream fails instead of hanging
+DOWNLOAD_TIMEOUT = (10, 120)
+
+# Number of processes decoding, cropping and encoding the downloaded images
+NUM_PROCESSING_WORKERS = os.cpu_count() or 1
+
+# Maximum number of images downloaded but not processed yet, which bounds the .part files on disk
+MAX_PENDING_IMAGES = NUM_DOWNLOAD_THREADS + 2 * NUM_PROCESSING_WORKERS
+
+# Pixels whose channels are all below this value are considered black borders
+BORDER_THRESHOLD = 100
+
+# Cloud Optimized GeoTIFF layout: internally tiled and compressed, with overviews
+COG_OPTIONS = {'driver': 'COG', 'blocksize': 256, 'compress': 'deflate', 'predictor': 'standard'}
+
+# Output images already on disk are not downloaded again, the manifest lists the completed ones
+# and, separately, the scales of a cell that are too fine to be downloaded
+MANIFEST_PATH = 'dataset/manifest.json'
+MIN_EXPECTED_BYTES = 1024
+
+# Keep-alive connections, so the TLS handshake is paid once and not per image
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=32, pool_maxsize=32))
+
+
+@njit(parallel=True, cache=True)
+def _black_borders_bbox(image, threshold):
+    # First and last non-black column of every row, on the (bands, height, width) array as read
+    # by rasterio, so that every scan runs over contiguous memory
+    bands, height, width = image.shape
+    first_cols = np.full(height, width, dtype=np.int64)
+    last_cols = np.full(height, -1, dtype=np.int64)
+
+    for i in prange(height):
+        for c in range(bands):
+            row = image[c, i]
+            # Black rows (the borders) are discarded with a single vectorized pass
+            if row.max() <= threshold:
+                continue
+
+            # Only the columns outside the span already found need to be scanned
+            for j in range(first_cols[i]):
+                if row[j] > threshold:
+                    first_cols[i] = j
+                    break
+            for j in range(width - 1, last_cols[i], -1):
+                if row[j] > threshold:
+                    last_cols[i] = j
+                    break
+
+    rows = np.flatnonzero(last_cols >= 0)
+    if rows.size == 0:
+        return -1, -1, -1, -1
+
+    return rows[0], rows[-1] + 1, first_cols.min(), last_cols.max() + 1
 
-    # Enhance the difference image to handle dark variations
-    diff = ImageChops.add(diff, diff, 2.0, -100)
 
-    bbox = diff.getbbox()
+def black_borders_bbox(image):
+    # Border pixels are (almost) black: keep those with at least one channel above the threshold
+    top, bottom, left, right = _black_borders_bbox(image, BORDER_THRESHOLD)
+    if top < 0:
+        return None
+
+    return top, bottom, left, right
+
+
+def crop_black_borders(image_path):
+    # Decoded straight into a NumPy array, RGB bands only
+    with rasterio.open(image_path) as src:
+        bbox = black_borders_bbox(src.read()[:3])
+        if bbox:
+            top, bottom, left, right = bbox
+            window = Window.from_slices((top, bottom), (left, right))
+            data, crs, transform = src.read(window=window), src.crs, src.window_transform(window)
+
+    # Written once the source is closed, since it is the same file
     if bbox:
-        image = image.crop(bbox)
-        image.save(image_path)
+        save_cog(data, crs, transform, image_path)
         print(f"Cropped")
     else:
         print(f"No need to crop")
 
 
-def get_image(center_point, pair, buffer_radius, scale):
-    center_latitude, center_longitude = center_point.latitude, center_point.longitude
-    x, y = pair
+def save_cog(data, crs, transform, output_path):
+    # The COG driver can only copy an existing dataset, hence the in-memory GeoTIFF
+    profile = {
+        'driver': 'GTiff',
+        'dtype': data.dtype,
+        'count': data.shape[0],
+        'height': data.shape[1],
+        'width': data.shape[2],
+        'crs': crs,
+        'transform': transform,
+    }
+    # Written next to the output and then renamed, so that an interrupted run never leaves
+    # a truncated image that looks downloaded
+    tmp_path = f'{output_path}.tmp'
+    try:
+        with MemoryFile() as memfile:
+            with memfile.open(**profile) as dataset:
+                dataset.write(data)
+            with memfile.open() as dataset:
+                rasterio.shutil.copy(dataset, tmp_path, **COG_OPTIONS)
+        os.replace(tmp_path, output_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def meters_per_degree(latitude):
+    # Length of a degree of latitude and longitude at the given latitude (WGS84)
+    phi = np.radians(latitude)
+    lat_meters = 111132.954 - 559.822 * np.cos(2 * phi) + 1.175 * np.cos(4 * phi)
+    lon_meters = 111412.84 * np.cos(phi) - 93.5 * np.cos(3 * phi) + 0.118 * np.cos(5 * phi)
+
+    return lat_meters, lon_meters
+
+
+def grid_points(p0, cell_side, num_cells_x, num_cells_y):
+    # Cell centers in closed form: x goes north and y goes east of p0, with offsets
+    # converted to degrees at the latitude of p0, so that each row follows a parallel
+    cells = np.indices((num_cells_x, num_cells_y)).reshape(2, -1).T
+    lat_meters, lon_meters = meters_per_degree(p0[0])
+    centers = np.asarray(p0) + cells * cell_side / np.array([lat_meters, lon_meters])
+
+    return cells, centers
+
+
+def get_out_folder(item):
+    x, y, center_latitude, center_longitude, _, _ = item
+    return f'dataset/{x}_{y}__{center_latitude}_{center_longitude}'
+
+
+def get_output_path(item, scale):
+    _, _, _, _, buffer_radius, _ = item
+    return f'{get_out_folder(item)}/naip_br{buffer_radius}_s{scale}.tif'
 
-    # Authentication and initialization
-    ee.Authenticate()
-    ee.Initialize(project='ee-francescobettisorbelli')
 
+def get_scale_key(item, scale):
+    _, _, _, _, buffer_radius, _ = item
+    return get_out_folder(item), buffer_radius, scale
+
+
+def load_manifest():
+    if not os.path.exists(MANIFEST_PATH):
+        return set(), set()
+
+    with open(MANIFEST_PATH) as file:
+        manifest = json.load(file)
+
+    return set(manifest['completed']), set(tuple(key) for key in manifest['unavailable'])
+
+
+def save_manifest(completed, unavailable):
+    os.makedirs(os.path.dirname(MANIFEST_PATH), exist_ok=True)
+    with open(MANIFEST_PATH, 'w') as file:
+        json.dump({'completed': sorted(completed), 'unavailable': sorted(unavailable)}, file, indent=1)
+
+
+def is_downloaded(item, completed, unavailable):
+    _, _, _, _, _, scales = item
+    for scale in scales:
+        if get_scale_key(item, scale) in unavailable:
+            continue
+
+        output_path = get_output_path(item, scale)
+        if output_path not in completed:
+            if not os.path.exists(output_path) or os.path.getsize(output_path) < MIN_EXPECTED_BYTES:
+                return False
+            completed.add(output_path)
+
+    return True
+
+
+def init_ee():
+    # Runs once per worker process
+    ee.Initialize(project=EE_PROJECT, opt_url=EE_HIGH_VOLUME_URL)
+
+
+def init_processing():
+    # The processes already use every CPU, the Numba kernel must not multiply the threads
+    set_num_threads(1)
+
+
+def naip_collection():
     # NAIP imagery is available only for the United States
-    point_US = ee.Geometry.Point(center_longitude, center_latitude)
+    return ee.ImageCollection('USDA/NAIP/DOQQ').filterDate('2020-01-01', '2023-12-31')
+
+
+def describe_cells(items):
+    # NAIP image and download region of every cell, computed server-side in a single round-trip
+    cells = ee.FeatureCollection([
+        ee.Feature(ee.Geometry.Point(center_longitude, center_latitude), {'buffer_radius': buffer_radius})
+        for _, _, center_latitude, center_longitude, buffer_radius, _ in items
+    ])
+
+    def describe(cell):
+        point = cell.geometry()
+        return cell.set({
+            # Empty when no NAIP image covers the cell center
+            'image_ids': naip_collection().filterBounds(point).limit(1).aggregate_array('system:id'),
+            # Defines a region within a circle of radius buffer_radius centered at the cell center
+            'region': point.buffer(ee.Number(cell.get('buffer_radius'))).bounds().coordinates(),
+        })
+
+    features = cells.map(describe).getInfo()['features']
 
-    # Select the NAIP image collection
-    collection = ee.ImageCollection('USDA/NAIP/DOQQ') \
-        .filterBounds(point_US) \
-        .filterDate('2020-01-01', '2023-12-31') \
-        .first()
+    jobs = []
+    for item, feature in zip(items, features):
+        image_ids, region = feature['properties']['image_ids'], feature['properties']['region']
+        if image_ids:
+            jobs.append((item, image_ids[0], region))
+        else:
+            x, y, center_latitude, center_longitude, _, _ = item
+            print(f"No NAIP image for ({x}, {y}) located at ({center_latitude}, {center_longitude}), skipped")
+
+    return jobs
+
+
+def get_download_url(job):
+    item, image_id, region = job
+    x, y, center_latitude, center_longitude, buffer_radius, scales = item
 
     # Define visualization parameters
     vis_params = {
@@ -53,72 +269,169 @@ def get_image(center_point, pair, buffer_radius, scale):
     }
 
     # Visualize the image
-    image = collection.visualize(**vis_params)
-
-    # Defines a region within a circle of radius buffer_radius centered at point_US
-    region = point_US.buffer(buffer_radius).bounds().getInfo()['coordinates']
-
-    # Get the download URL
+    image = ee.Image(image_id).visualize(**vis_params)
+
+    # Only the finest scale that can be downloaded is needed, coarser ones are obtained locally
+    for scale in sorted(scales):
+        try:
+            url = image.getDownloadURL({
+                'scale': scale,
+                'region': region,
+                'format': 'GEO_TIFF'
+            })
+        except ee.ee_exception.EEException as e:
+            print(e)
+            if EE_SIZE_LIMIT_ERROR not in str(e):
+                # E.g., too many requests: nothing to do with the scale, the cell is retried on the next run
+                print(f"Cell ({x}, {y}) skipped")
+                return item, None, None
+
+            print(f"Try to *either* increase 'scale' (now {scale}) or decrease 'buffer_radius' (now {buffer_radius})")
+            continue
+        except Exception as e:
+            # E.g., a network timeout of the EE client: the cell is retried on the next run
+            print(f"Cell ({x}, {y}) skipped: {e!r}")
+            return item, None, None
+
+        # Finer scales cannot be obtained from a coarser download
+        skipped = [s for s in scales if s < scale]
+        if skipped:
+            print(f"Cell ({x}, {y}): scales {skipped} not produced, the finest downloadable scale is {scale}")
+
+        return item, scale, url
+
+    print(f"Cell ({x}, {y}): no scale could be downloaded, skipped")
+
+    return item, None, None
+
+
+def download_image(url, item, base_scale, crop, processing_pool, release):
+    _, _, _, _, buffer_radius, _ = item
+
+    # Stream the image to disk in 1 MiB chunks, instead of holding the whole response in memory
+    download_path = f'{get_out_folder(item)}/naip_br{buffer_radius}.part'
     try:
-        url = image.getDownloadURL({
-            'scale': scale,
-            'region': region,
-            'format': 'GeoTIFF'
-        })
-    except ee.ee_exception.EEException as e:
-        print(e)
-        print(f"Try to *either* increase 'scale' (now {scale}) or decrease 'buffer_radius' (now {buffer_radius})")
-        return 1
-
-    # Download the image
-    response = requests.get(url)
+        with SESSION.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+            # E.g., 429 or 5xx from EE: the body is an error message, not an image
+            response.raise_for_status()
+            with open(download_path, 'wb') as file:
+                response.raw.decode_content = True
+                shutil.copyfileobj(response.raw, file, length=1024 * 1024)
+    except BaseException:
+        if os.path.exists(download_path):
+            os.remove(download_path)
+        release()
+        raise
+
+    # Decoding, cropping and encoding are CPU-bound: hand them over to the processing
+    # pool, so that this thread can move on to the next download right away
+    return processing_pool.apply_async(process_image, (download_path, item, base_scale, crop),
+                                       callback=lambda _: release(), error_callback=lambda _: release())
+
+
+def process_image(download_path, item, base_scale, crop):
+    _, _, _, _, _, scales = item
+    output_paths = []
 
-    # Save the image to a file
-    out_folder = f'dataset/{x}_{y}__{center_latitude}_{center_longitude}'
-    if not os.path.exists(out_folder):
-        os.makedirs(out_folder)
+    try:
+        # Save the images to files
+        with rasterio.open(download_path) as src:
+            window = Window(0, 0, src.width, src.height)
 
-    output_path = f'{out_folder}/naip_br{buffer_radius}_s{scale}.tif'
-    with open(output_path, 'wb') as file:
-        file.write(response.content)
+            # Crop in memory, so that every image is encoded and written only once
+            bbox = black_borders_bbox(src.read()) if crop else None
+            if bbox:
+                top, bottom, left, right = bbox
+                window = Window.from_slices((top, bottom), (left, right))
 
-    print(f'Image downloaded={output_path}')
+            # Coarser scales are area-averaged from the downloaded one instead of being downloaded again
+            for scale in sorted(s for s in scales if s >= base_scale):
+                factor = base_scale / scale
+                height, width = max(1, round(window.height * factor)), max(1, round(window.width * factor))
+                data = src.read(window=window, out_shape=(src.count, height, width), resampling=Resampling.average)
+                transform = src.window_transform(window) * Affine.scale(window.width / width, window.height / height)
 
-    # crop_black_borders(output_path)
+                output_path = get_output_path(item, scale)
+                save_cog(data, src.crs, transform, output_path)
+                output_paths.append(output_path)
 
-    return 0
+                print(f'Image downloaded={output_path}')
+    finally:
+        os.remove(download_path)
 
+    return output_paths
 
-def download_satellite_images(p0, cell_side, num_cells_x, num_cells_y):
-    # Create a starting point as a geopy Point object
-    start_point = Point(p0[0], p0[1])
 
+def download_satellite_images(p0, cell_side, num_cells_x, num_cells_y, crop):
     print(f"Grid formed by {num_cells_x} x {num_cells_y} cells")
 
-    for x in range(num_cells_x):
-        for y in range(num_cells_y):
-            # Calculate distance in meters from the starting point
-            distance_east = y * cell_side
-            distance_north = x * cell_side
-
-            # Calculate new point using geodesic function
-            center_point = geodesic(meters=distance_east).destination(start_point, 90)  # East direction
-            center_point = geodesic(meters=distance_north).destination(center_point, 0)  # North direction
-
-            # dist = geodesic(start_point, center_point).km
-
-            print(f"Evaluating ({x}, {y}) located at ({center_point.latitude}, {center_point.longitude})")
-
-            buffer_radius = int(cell_side / 2)
-            scales = [0.6, 1, 2, 3, 4, 5]
-
-            for scale in scales:
-                status = get_image(center_point, (x, y), buffer_radius, scale)
-                if status == 1:
+    buffer_radius = int(cell_side / 2)
+    scales = [0.6, 1, 2, 3, 4, 5]
+
+    cells, centers = grid_points(p0, cell_side, num_cells_x, num_cells_y)
+
+    # Build every cell job up front, then download them in parallel
+    items = []
+    for (x, y), (center_latitude, center_longitude) in zip(cells.tolist(), centers.tolist()):
+        print(f"Evaluating ({x}, {y}) located at ({center_latitude}, {center_longitude})")
+
+        items.append((x, y, center_latitude, center_longitude, buffer_radius, scales))
+
+    # Cells whose images are all there already (e.g., from an interrupted run) are skipped
+    completed, unavailable = load_manifest()
+    items = [item for item in items if not is_downloaded(item, completed, unavailable)]
+    print(f"{len(items)} cells to download")
+
+    # Output folders are created once here, not for every image
+    for out_folder in {get_out_folder(item) for item in items}:
+        os.makedirs(out_folder, exist_ok=True)
+
+    # Cells outside NAIP coverage are discarded before asking for any download URL,
+    # the others get their image and region without further round-trips
+    init_ee()
+    jobs = []
+    for start in range(0, len(items), DESCRIBE_BATCH_SIZE):
+        jobs += describe_cells(items[start:start + DESCRIBE_BATCH_SIZE])
+
+    # URL generation (EE compute), downloads and image processing overlap: every URL is handed
+    # to the download threads as soon as a worker produces it, and every downloaded image
+    # to the processing pool
+    with multiprocessing.Pool(NUM_WORKERS, initializer=init_ee) as pool, \
+            multiprocessing.Pool(NUM_PROCESSING_WORKERS, initializer=init_processing) as processing_pool, \
+            ThreadPoolExecutor(NUM_DOWNLOAD_THREADS) as download_pool:
+        # Released once an image is processed (or fails), so downloads cannot run too far ahead
+        pending = threading.BoundedSemaphore(MAX_PENDING_IMAGES)
+
+        futures = []
+        try:
+            for item, scale, url in pool.imap_unordered(get_download_url, jobs):
+                if url is not None:
+                    pending.acquire()
+                    future = download_pool.submit(download_image, url, item, scale, crop, processing_pool,
+                                                  pending.release)
+                    futures.append((item, scale, future))
+
+            for item, base_scale, future in futures:
+                x, y, _, _, _, scales = item
+
+                # A failed cell is reported and left for the next run, the others go on
+                try:
+                    completed.update(future.result().get())
+                except Exception as e:
+                    print(f"Cell ({x}, {y}) failed: {e!r}")
                     continue
 
+                # Scales finer than the downloaded one exceed the EE limits, so they do not
+                # make the cell look unfinished on the next run
+                unavailable.update(get_scale_key(item, s) for s in scales if s < base_scale)
+        finally:
+            save_manifest(completed, unavailable)
+
 
 if __name__ == "__main__":
+    # Authentication (interactive only the first time, credentials are then cached)
+    ee.Authenticate()
+
     ####### Parameters
     # Latitude and longitude of the bottom-left cell center of the area, respectively
     p_0 = (37.910715173463, -91.77332884614303)
@@ -129,4 +442,7 @@ if __name__ == "__main__":
     # Cell side (it is a square) in meters
     cell_side = 1000
 
-    download_satellite_images(p_0, cell_side, num_cells_x, num_cells_y)
+    # Whether to crop the black borders of the downloaded images
+    crop = False
+
+    download_satellite_images(p_0, cell_side, num_cells_x, num_cells_y, crop)